@@ -62,6 +62,18 @@ def _field_matches(
     field_name: one of [documents, metadatas]
     """
     result = collection.get(ids=embeddings["ids"], include=[field_name])
+    _result_field_matches(result, embeddings, field_name)
+
+
+def _result_field_matches(
+    result: types.GetResult,
+    embeddings: RecordSet,
+    field_name: Union[Literal["documents"], Literal["metadatas"]],
+):
+    """
+    The embedding field in the given get result is equal to the expected field
+    field_name: one of [documents, metadatas]
+    """
     # The test_out_of_order_ids test fails because of this in test_add.py
     # Here we sort by the ids to match the input order
     embedding_id_to_index = {id: i for i, id in enumerate(embeddings["ids"])}
@@ -87,8 +99,14 @@ def _field_matches(
 
 def ids_match(collection: Collection, embeddings: RecordSet):
     """The actual embedding ids is equal to the expected ids"""
+    result = collection.get(ids=wrap_all(embeddings)["ids"], include=[])
+    ids_match_from(result, embeddings)
+
+
+def ids_match_from(result: types.GetResult, embeddings: RecordSet):
+    """The embedding ids in the given get result is equal to the expected ids"""
     embeddings = wrap_all(embeddings)
-    actual_ids = collection.get(ids=embeddings["ids"], include=[])["ids"]
+    actual_ids = result["ids"]
     # The test_out_of_order_ids test fails because of this in test_add.py
     # Here we sort the ids to match the input order
     embedding_id_to_index = {id: i for i, id in enumerate(embeddings["ids"])}
@@ -108,6 +126,20 @@ def documents_match(collection: Collection, embeddings: RecordSet):
     _field_matches(collection, embeddings, "documents")
 
 
+def metadatas_match_from(result: types.GetResult, embeddings: RecordSet):
+    """The embedding metadata in the given get result is equal to the expected
+    metadata"""
+    embeddings = wrap_all(embeddings)
+    _result_field_matches(result, embeddings, "metadatas")
+
+
+def documents_match_from(result: types.GetResult, embeddings: RecordSet):
+    """The embedding documents in the given get result is equal to the expected
+    documents"""
+    embeddings = wrap_all(embeddings)
+    _result_field_matches(result, embeddings, "documents")
+
+
 def no_duplicates(collection: Collection):
     ids = collection.get()["ids"]
     assert len(ids) == len(set(ids))
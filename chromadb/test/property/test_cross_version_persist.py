@@ -1,27 +1,49 @@
 import sys
 import os
+import atexit
+import functools
+import dataclasses
+import hashlib
 import shutil
 import subprocess
 import tempfile
-from typing import Generator, Tuple
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from types import ModuleType
+from typing import Callable, Dict, Generator, List, Optional, Set, Tuple
 from hypothesis import given, settings
 import hypothesis.strategies as st
 import pytest
 import json
 from urllib import request
 from chromadb.api import API
+from chromadb.api.models.Collection import Collection
+from chromadb.api.types import GetResult
 import chromadb.test.property.strategies as strategies
 import chromadb.test.property.invariants as invariants
+import importlib
 from importlib.util import spec_from_file_location, module_from_spec
 from packaging import version as packaging_version
 import re
 import multiprocessing
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
 from chromadb import Client
 from chromadb.config import Settings
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 MINIMUM_VERSION = "0.3.20"
 COLLECTION_NAME_LOWERCASE_VERSION = "0.3.21"
 version_re = re.compile(r"^[0-9]+\.[0-9]+\.[0-9]+$")
+versions_cache_path = tempfile.gettempdir() + "/chromadb_versions.json"
+VERSIONS_CACHE_TTL = 60 * 60
 
 
 def _patch_uppercase_coll_name(
@@ -45,28 +67,69 @@ version_patches = [
 ]
 
 
-def patch_for_version(
-    version, collection: strategies.Collection, embeddings: strategies.RecordSet
-):
-    """Override aspects of the collection and embeddings, before testing, to account for
-    breaking changes in old versions."""
+def _version_key(version: str) -> Tuple[int, ...]:
+    """Comparison key for the N.N.N versions matched by version_re, cheaper than full
+    PEP 440 parsing"""
+    return tuple(int(part) for part in version.split("."))
 
-    for patch_version, patch in version_patches:
-        if packaging_version.Version(version) <= packaging_version.Version(
-            patch_version
-        ):
-            patch(collection, embeddings)
 
+# The patch versions are constant, so parse them once
+_parsed_version_patches = [
+    (_version_key(patch_version), patch) for patch_version, patch in version_patches
+]
 
-def versions():
-    """Returns the pinned minimum version and the latest version of chromadb."""
+
+def patches_for_version(
+    version,
+) -> List[Callable[[strategies.Collection, strategies.RecordSet], None]]:
+    """Returns the patches overriding aspects of the collection and embeddings, before
+    testing, to account for breaking changes in old versions."""
+    parsed_version = _version_key(version)
+    return [
+        patch
+        for patch_version, patch in _parsed_version_patches
+        if parsed_version <= patch_version
+    ]
+
+
+def _fetch_versions() -> List[str]:
+    """Returns the released versions of chromadb on PyPI, sorted from oldest to
+    newest."""
     url = "https://pypi.org/pypi/chromadb/json"
     data = json.load(request.urlopen(request.Request(url)))
-    versions = list(data["releases"].keys())
+    # Filter and parse in a single pass, so that each version is parsed only once.
     # Older versions on pypi contain "devXYZ" suffixes
-    versions = [v for v in versions if version_re.match(v)]
-    versions.sort(key=packaging_version.Version)
-    return [MINIMUM_VERSION, versions[-1]]
+    parsed_versions = [
+        (packaging_version.Version(v), v)
+        for v in data["releases"]
+        if version_re.fullmatch(v)
+    ]
+    parsed_versions.sort(key=lambda parsed_version: parsed_version[0])
+    return [v for _, v in parsed_versions]
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_versions() -> Tuple[str, ...]:
+    """Returns the sorted released versions of chromadb, from a file cache if it was
+    written less than VERSIONS_CACHE_TTL seconds ago, else from PyPI."""
+    try:
+        if time.time() - os.path.getmtime(versions_cache_path) < VERSIONS_CACHE_TTL:
+            with open(versions_cache_path) as f:
+                return tuple(json.load(f))
+    except (OSError, ValueError):
+        pass  # Missing or corrupt cache, refetch it
+    versions = _fetch_versions()
+    # Write and rename so concurrent test processes never read a partial cache
+    tmp_path = f"{versions_cache_path}.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(versions, f)
+    os.replace(tmp_path, versions_cache_path)
+    return tuple(versions)
+
+
+def versions():
+    """Returns the pinned minimum version and the latest version of chromadb."""
+    return [MINIMUM_VERSION, _cached_versions()[-1]]
 
 
 def configurations(versions):
@@ -85,23 +148,120 @@ def configurations(versions):
 
 test_old_versions = versions()
 base_install_dir = tempfile.gettempdir() + "/persistence_test_chromadb_versions"
+# pip's http and wheel cache, kept outside the install targets so it survives cleanup
+pip_cache_dir = os.environ.get("PIP_CACHE_DIR", base_install_dir + "/pipcache")
+# Set to keep the installed versions around after the tests, for faster reruns
+KEEP_VERSION_INSTALLS_ENV = "CHROMA_KEEP_VERSION_INSTALLS"
+
+
+@pytest.fixture(scope="session")
+def installed_versions(request) -> List[str]:
+    """Install the selected versions up front. The installs are independent and
+    mostly spent waiting on pip, so run them concurrently."""
+    versions = selected_versions(request.session)
+    if versions:
+        with ThreadPoolExecutor(max_workers=len(versions)) as executor:
+            list(executor.map(install_version, versions))
+    return versions
+
+
+@pytest.fixture(scope="session")
+def version_workers(
+    installed_versions: List[str],
+) -> Generator[Dict[str, Tuple[BaseProcess, Connection]], None, None]:
+    """Start the workers persisting data for the selected versions up front, so that
+    later versions load in the background while earlier versions are tested. Workers
+    missing later on are started on demand by version_worker."""
+    workers = {version: start_worker(version) for version in installed_versions}
+    yield workers
+    # Workers not already stopped by version_settings
+    for worker, conn in workers.values():
+        stop_worker(worker, conn)
+
+
+def selected_versions(session: pytest.Session) -> List[str]:
+    """Returns the versions version_settings is used with by the collected tests, in
+    order, leaving out the deselected ones"""
+    selected: List[str] = []
+    for item in session.items:
+        callspec = getattr(item, "callspec", None)
+        if callspec is None or "version_settings" not in callspec.params:
+            continue
+        version = callspec.params["version_settings"][0]
+        if version not in selected:
+            selected.append(version)
+    return selected
+
+
+def version_worker(
+    workers: Dict[str, Tuple[BaseProcess, Connection]], version: str
+) -> Tuple[BaseProcess, Connection]:
+    """Returns the running worker for the given version, starting it if it is missing
+    from workers or has exited"""
+    if version in workers and not workers[version][0].is_alive():
+        stop_worker(*workers.pop(version))
+    if version not in workers:
+        # The install may have been removed since the session started
+        install_version(version)
+        workers[version] = start_worker(version)
+    return workers[version]
 
 
 # This fixture is not shared with the rest of the tests because it is unique in how it
 # installs the versions of chromadb
 @pytest.fixture(scope="module", params=configurations(test_old_versions))
-def version_settings(request) -> Generator[Tuple[str, Settings], None, None]:
+def version_settings(
+    request, version_workers: Dict[str, Tuple[BaseProcess, Connection]]
+) -> Generator[Tuple[str, Settings], None, None]:
     configuration = request.param
-    version = configuration[0]
+    version, settings = configuration
+    # Installed up front by installed_versions, but removed again by the teardown of
+    # an earlier setup for the same version. Wait for that removal to finish first
+    removal = _version_removals.pop(version, None)
+    if removal is not None:
+        removal.join()
     install_version(version)
+    # The current version's clients persist the data at exit too, into directories
+    # the teardown already removed. atexit runs its handlers last in first out, so
+    # this removes the persisted data again after all of them
+    atexit.register(shutil.rmtree, settings.persist_directory, ignore_errors=True)
     yield configuration
-    # Cleanup the installed version
-    path = get_path_to_version_install(version)
-    shutil.rmtree(path)
+    # Stop the worker before cleaning up, it may still write to the persisted data
+    if version in version_workers:
+        stop_worker(*version_workers.pop(version))
     # Cleanup the persisted data
-    data_path = configuration[1].persist_directory
-    if os.path.exists(data_path):
-        shutil.rmtree(data_path)
+    paths = [settings.persist_directory]
+    _persisted_directories.difference_update(
+        [
+            path
+            for path in _persisted_directories
+            if path.startswith(settings.persist_directory)
+        ]
+    )
+    # Cleanup the installed version, unless asked to keep it for the next run
+    if not os.environ.get(KEEP_VERSION_INSTALLS_ENV):
+        _known_installed_versions.discard(version)
+        paths.append(get_path_to_version_install(version))
+    _version_removals[version] = remove_in_background(paths)
+
+
+# Background removals of the data and installs of versions torn down by
+# version_settings
+_version_removals: Dict[str, threading.Thread] = {}
+
+
+def remove_in_background(paths: List[str]) -> threading.Thread:
+    """Remove the given directories in a background thread, so that the next tests
+    don't wait on it. The thread is not a daemon thread, so the interpreter still
+    waits for it to finish before exiting."""
+
+    def remove():
+        for path in paths:
+            shutil.rmtree(path, ignore_errors=True)
+
+    thread = threading.Thread(target=remove)
+    thread.start()
+    return thread
 
 
 def get_path_to_version_install(version):
@@ -112,54 +272,127 @@ def get_path_to_version_library(version):
     return get_path_to_version_install(version) + "/chromadb/__init__.py"
 
 
+@contextmanager
+def version_install_lock(version):
+    """Hold an exclusive lock on the install of a version, so that processes sharing
+    the install dir (e.g. pytest-xdist workers) don't race on the same target"""
+    os.makedirs(base_install_dir, exist_ok=True)
+    with open(get_path_to_version_install(version) + ".lock", "w") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+# Versions this process installed or found installed, to skip the locking and
+# filesystem checks when asked again
+_known_installed_versions: Set[str] = set()
+
+
 def install_version(version):
-    # Check if already installed
-    version_library = get_path_to_version_library(version)
-    if os.path.exists(version_library):
+    if version in _known_installed_versions:
         return
-    path = get_path_to_version_install(version)
-    install(f"chromadb=={version}", path)
+    with version_install_lock(version):
+        # Check if already installed
+        version_library = get_path_to_version_library(version)
+        if os.path.exists(version_library):
+            _known_installed_versions.add(version)
+            return
+        path = get_path_to_version_install(version)
+        install(f"chromadb=={version}", path)
+    _known_installed_versions.add(version)
 
 
 def install(pkg, path):
+    print(f"Installing chromadb version {pkg} to {path}")
     # -q -q to suppress pip output to ERROR level
     # https://pip.pypa.io/en/stable/cli/pip/#quiet
-    print(f"Installing chromadb version {pkg} to {path}")
-    return subprocess.check_call(
+    # Downloads, and wheels built from sdists, are served from pip's cache after the
+    # first run
+    run_pip(
         [
-            sys.executable,
-            "-m",
-            "pip",
             "-q",
             "-q",
             "install",
             pkg,
             "--target={}".format(path),
+            "--cache-dir",
+            pip_cache_dir,
+            "--disable-pip-version-check",
         ]
     )
 
 
+def run_pip(args: List[str]):
+    """Run pip without sharing the terminal, so that concurrent installs don't contend
+    on it. Its errors are only written out if it fails."""
+    process = subprocess.Popen(
+        [sys.executable, "-m", "pip"] + args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    _, stderr = process.communicate()
+    if process.returncode != 0:
+        sys.stderr.write(stderr.decode(errors="replace"))
+        raise subprocess.CalledProcessError(
+            process.returncode, process.args, stderr=stderr
+        )
+
+
+# Modules of the old versions already loaded by switch_to_version
+_version_modules: Dict[str, ModuleType] = {}
+
+
+# Install paths of the old versions switch_to_version put on sys.path
+_version_install_paths: Set[str] = set()
+
+
+def _use_version_install_path(install_path: str):
+    """Put the install path of a version first on sys.path, replacing the paths of
+    previously used versions so that sys.path doesn't grow with every switch"""
+    if sys.path[:1] == [install_path]:
+        return
+    for path in _version_install_paths.intersection(sys.path):
+        # Drop the finders for the removed paths along with them
+        sys.path_importer_cache.pop(path, None)
+    sys.path[:] = [path for path in sys.path if path not in _version_install_paths]
+    sys.path.insert(0, install_path)
+    _version_install_paths.add(install_path)
+    importlib.invalidate_caches()
+
+
 def switch_to_version(version):
     module_name = "chromadb"
-    # Remove old version from sys.modules, except test modules
-    old_modules = {
-        n: m
-        for n, m in sys.modules.items()
-        if n == module_name or (n.startswith(module_name + "."))
-    }
-    for n in old_modules:
-        del sys.modules[n]
+    # The worker persisting data for a version switches to it on each example, so
+    # reuse the already loaded module as long as it is still the active one
+    module = _version_modules.get(version)
+    if module is not None and sys.modules.get(module_name) is module:
+        return module
+
+    # Remove old version from sys.modules, except test modules. The worker persisting
+    # data unpickles the generated data, whose types live in the test modules, after
+    # switching versions
+    modules = sys.modules
+    prefix = module_name + "."
+    test_prefix = prefix + "test"
+    for n in [
+        n
+        for n in modules
+        if (n == module_name or n.startswith(prefix))
+        and not (n == test_prefix or n.startswith(test_prefix + "."))
+    ]:
+        del modules[n]
 
     # Load the target version and override the path to the installed version
     # https://docs.python.org/3/library/importlib.html#importing-a-source-file-directly
     path = get_path_to_version_library(version)
-    sys.path.insert(0, get_path_to_version_install(version))
+    _use_version_install_path(get_path_to_version_install(version))
     spec = spec_from_file_location(module_name, path)
     assert spec is not None and spec.loader is not None
     module = module_from_spec(spec)
     spec.loader.exec_module(module)
     assert module.__version__ == version
     sys.modules[module_name] = module
+    _version_modules[version] = module
     return module
 
 
@@ -182,29 +415,154 @@ def persist_generated_data_with_old_version(
     # Just use some basic checks for sanity and manual testing where you break the new
     # version
 
-    check_embeddings = invariants.wrap_all(embeddings_strategy)
+    # These checks only need the ids, so don't wrap the rest of the record set. Every
+    # generated record has an embedding, so the ids also give the expected count
+    check_ids = invariants.maybe_wrap(embeddings_strategy["ids"])
     # Check count
-    assert coll.count() == len(check_embeddings["embeddings"] or [])
-    # Check ids
+    assert coll.count() == len(check_ids)
+    # Check ids, the order they are returned in doesn't matter
     result = coll.get()
-    actual_ids = result["ids"]
-    embedding_id_to_index = {id: i for i, id in enumerate(check_embeddings["ids"])}
-    actual_ids = sorted(actual_ids, key=lambda id: embedding_id_to_index[id])
-    assert actual_ids == check_embeddings["ids"]
+    assert sorted(result["ids"]) == sorted(check_ids)
     api.persist()
     del api
 
 
+def worker_context() -> multiprocessing.context.BaseContext:
+    """Returns the multiprocessing context for the old version workers. Not using fork,
+    to avoid sharing the current process memory which would cause the current version
+    to be loaded. Where available, forkserver forks the workers from a clean server
+    process, which is much cheaper than spawning a new interpreter."""
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    ctx = multiprocessing.get_context("forkserver")
+    # Heavy dependencies the worker imports anyway through this module, preloading
+    # them in the server means the forked workers inherit them already imported. Must
+    # not include chromadb.
+    ctx.set_forkserver_preload(["numpy", "pandas", "hypothesis", "pytest"])
+    return ctx
+
+
+def persist_directory_for(
+    settings: Settings,
+    collection: strategies.Collection,
+    embeddings: strategies.RecordSet,
+) -> str:
+    """Returns the directory to persist the given generated data to, under the
+    version's persist directory and unique to the data"""
+    data = json.dumps(
+        [dataclasses.asdict(collection), embeddings], sort_keys=True, default=str
+    )
+    digest = hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+    return settings.persist_directory + digest
+
+
+# Directories this process persisted generated data to with the old versions. Data
+# found on disk otherwise may be left over from an earlier run, and rewritten by the
+# current version since, e.g. by its persist at exit
+_persisted_directories: Set[str] = set()
+
+
+def start_worker(version) -> Tuple[BaseProcess, Connection]:
+    """Start a worker persisting data with the given version, in a separate long lived
+    process to avoid polluting the current process with the old version"""
+    ctx = worker_context()
+    conn, worker_conn = ctx.Pipe()
+    worker = ctx.Process(
+        target=persist_worker, args=(version, worker_conn), daemon=True
+    )
+    worker.start()
+    worker_conn.close()
+    return worker, conn
+
+
+def stop_worker(worker: BaseProcess, conn: Connection):
+    try:
+        conn.send(None)
+    except BrokenPipeError:
+        pass  # The worker already exited
+    worker.join()
+    conn.close()
+
+
+def persist_with_worker(
+    workers: Dict[str, Tuple[BaseProcess, Connection]],
+    version,
+    settings,
+    collection_strategy: strategies.Collection,
+    embeddings_strategy: strategies.RecordSet,
+) -> Optional[str]:
+    """Persist generated data with the version's worker, and return its reply. A
+    worker exiting mid example, e.g. the old version crashing the process, is reported
+    as a failure too, and a new worker is started for the next example."""
+    worker, conn = version_worker(workers, version)
+    try:
+        conn.send((version, settings, collection_strategy, embeddings_strategy))
+        return conn.recv()
+    except (EOFError, ConnectionError):
+        stop_worker(*workers.pop(version))
+        version_worker(workers, version)
+        return f"The worker for version {version} exited with code {worker.exitcode}"
+
+
+def persist_worker(version, conn: Connection):
+    """Run persist_generated_data_with_old_version for each set of arguments received
+    over conn, until None is received. Replies with None on success, or with the
+    formatted traceback of the failure."""
+    # Load the old version right away, so it is ready by the first example
+    try:
+        switch_to_version(version)
+    except Exception:
+        pass  # Reported by the first example instead
+    while True:
+        args = conn.recv()
+        if args is None:
+            break
+        try:
+            persist_generated_data_with_old_version(*args)
+        except Exception:
+            conn.send(traceback.format_exc())
+        else:
+            conn.send(None)
+    conn.close()
+
+
 # Since we can't pickle the embedding function, we always generate record sets with embeddings
 collection_st = st.shared(
     strategies.collections(with_hnsw_params=True, has_embeddings=True), key="coll"
 )
 
 
-@given(
-    collection_strategy=collection_st,
-    embeddings_strategy=strategies.recordsets(collection_st),
-)
+@functools.lru_cache(maxsize=None)
+def patched_collections_and_recordsets(
+    version,
+) -> st.SearchStrategy[Tuple[strategies.Collection, strategies.RecordSet]]:
+    """Strategy to generate a collection and a record set for it, patched for the
+    given version. Patching inside the strategy lets Hypothesis generate and shrink
+    the patched values directly."""
+    patches = patches_for_version(version)
+
+    def patch_for_version(
+        collection_and_embeddings: Tuple[strategies.Collection, strategies.RecordSet]
+    ) -> Tuple[strategies.Collection, strategies.RecordSet]:
+        collection, embeddings = collection_and_embeddings
+        for patch in patches:
+            patch(collection, embeddings)
+        # Can't pickle a function, and we won't need them
+        collection.embedding_function = None
+        collection.known_metadata_keys = {}
+        return collection, embeddings
+
+    return st.tuples(collection_st, strategies.recordsets(collection_st)).map(
+        patch_for_version
+    )
+
+
+def _fetch_all(coll: Collection) -> GetResult:
+    """Fetch the ids, metadatas and documents of every record in the collection"""
+    return coll.get(include=["metadatas", "documents"])
+
+
+@given(data=st.data())
 @pytest.mark.skipif(
     sys.version_info.major < 3
     or (sys.version_info.major == 3 and sys.version_info.minor <= 7),
@@ -213,30 +571,33 @@ collection_st = st.shared(
 @settings(deadline=None)
 def test_cycle_versions(
     version_settings: Tuple[str, Settings],
-    collection_strategy: strategies.Collection,
-    embeddings_strategy: strategies.RecordSet,
+    version_workers: Dict[str, Tuple[BaseProcess, Connection]],
+    data: st.DataObject,
 ):
     # # Test backwards compatibility
     # # For the current version, ensure that we can load a collection from
     # # the previous versions
     version, settings = version_settings
 
-    patch_for_version(version, collection_strategy, embeddings_strategy)
-
-    # Can't pickle a function, and we won't need them
-    collection_strategy.embedding_function = None
-    collection_strategy.known_metadata_keys = {}
+    collection_strategy, embeddings_strategy = data.draw(
+        patched_collections_and_recordsets(version)
+    )
 
-    # Run the task in a separate process to avoid polluting the current process
-    # with the old version. Using spawn instead of fork to avoid sharing the
-    # current process memory which would cause the old version to be loaded
-    ctx = multiprocessing.get_context("spawn")
-    p = ctx.Process(
-        target=persist_generated_data_with_old_version,
-        args=(version, settings, collection_strategy, embeddings_strategy),
+    persist_directory = persist_directory_for(
+        settings, collection_strategy, embeddings_strategy
     )
-    p.start()
-    p.join()
+    settings = settings.copy(update={"persist_directory": persist_directory})
+    # Data already persisted with the old version, e.g. when Hypothesis replays an
+    # example while shrinking, only needs to be checked with the current version
+    if persist_directory not in _persisted_directories:
+        # Persist the data with the old version in the version's worker process, from
+        # scratch rather than on top of data left over from an earlier run
+        shutil.rmtree(persist_directory, ignore_errors=True)
+        error = persist_with_worker(
+            version_workers, version, settings, collection_strategy, embeddings_strategy
+        )
+        assert error is None, error
+        _persisted_directories.add(persist_directory)
 
     # Switch to the current version (local working directory) and check the invariants
     # are preserved for the collection
@@ -245,7 +606,9 @@ def test_cycle_versions(
         name=collection_strategy.name, embedding_function=lambda x: None
     )
     invariants.count(coll, embeddings_strategy)
-    invariants.metadatas_match(coll, embeddings_strategy)
-    invariants.documents_match(coll, embeddings_strategy)
-    invariants.ids_match(coll, embeddings_strategy)
+    # Check the field and id invariants against a single get
+    result = _fetch_all(coll)
+    invariants.metadatas_match_from(result, embeddings_strategy)
+    invariants.documents_match_from(result, embeddings_strategy)
+    invariants.ids_match_from(result, embeddings_strategy)
     invariants.ann_accuracy(coll, embeddings_strategy)